@@ -1,189 +1,421 @@
-import aiohttp
 import asyncio
-import pandas as pd
+import csv
+import httpx
+import orjson
+import re
+from operator import itemgetter
 import time
 import logging
 
+try:
+    import simdjson
+except ImportError:  # pysimdjson has no wheels for some platforms, stream with ijson instead
+    simdjson = None
+    import ijson
+
+try:
+    import uvloop
+except ImportError:  # uvloop does not support Windows, the default event loop is used there
+    uvloop = None
+
 
 # Configure logging to provide detailed information about the scraping process
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+logger = logging.getLogger(__name__)
+
+# Sreality API endpoints for property details and search result pages
+_DETAIL_URL = 'https://www.sreality.cz/api/cs/v2/estates/'
+_PAGE_URL = 'https://www.sreality.cz/api/cs/v2/estates?category_main_cb=1&category_type_cb=1&no_shares=1&bez-aukce=1&page='
+
+# Browser-like headers sent with every request to the API
+_PAGE_HEADERS = {
+    'accept': 'application/json, text/plain, */*',
+    'accept-language': 'sk-SK,sk;q=0.9,cs;q=0.8,en-US;q=0.7,en;q=0.6',
+    'referer': 'https://www.sreality.cz/hledani/prodej/byty?no_shares=1&bez-aukce=1',
+    'sec-ch-ua': '"Google"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-platform': '"Windows"',
+    'sec-fetch-dest': 'empty',
+    'sec-fetch-mode': 'cors',
+    'sec-fetch-site': 'same-origin',
+    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36',
+}
+
+# Matches the numeric property IDs in the raw JSON of a search result page
+_HASH_ID_RE = re.compile(rb'"hash_id"\s*:\s*(\d+)')
+
+# Reads the name and value of an entry in the 'items' list of a property in one call
+_item_name_value = itemgetter('name', 'value')
+
+# Prefixes of the fields read by parse_detail_stream and the columns they are written to
+_STREAM_FIELDS = {
+    'name.value': 'title',
+    'meta_description': 'description',
+    'locality.value': 'address',
+    'price_czk.value_raw': 'price',
+    '_embedded.seller.user_name': 'seller_name',
+    '_embedded.seller.email': 'seller_email',
+    '_embedded.seller.user_id': 'seller_id',
+}
+_STREAM_PHONE_FIELDS = {
+    '_embedded.seller.phones.item.code': 'code_number',
+    '_embedded.seller.phones.item.number': 'seller_phone',
+}
+
+# Number of tasks fetching property details concurrently
+DETAIL_TASKS = 50
+
+# Number of search result pages fetched concurrently
+PAGE_PREFETCH = 10
+
+# File the scraped properties are written to, one row per property; kept apart from the
+# sample output in sreality_output_data.csv
+OUTPUT_CSV = 'sreality_scraped_data.csv'
+
+# Number of properties buffered to discover the output columns before the CSV header is written
+SCHEMA_WARMUP = 100
+
+# Output columns: the fixed property fields followed by the known names from the 'items' list,
+# extended with the names found in the first SCHEMA_WARMUP properties
+CSV_FIELDNAMES = [
+    'title', 'description', 'address', 'price', 'seller_name', 'seller_email', 'seller_id',
+    'code_number', 'seller_phone',
+    'Celková cena', 'Aktualizace', 'ID', 'Stavba', 'Stav objektu', 'Vlastnictví', 'Podlaží',
+    'Užitná plocha', 'Balkón', 'Sklep', 'Voda', 'Topení', 'Odpad', 'Telekomunikace', 'Elektřina',
+    'Doprava', 'Komunikace', 'Energetická náročnost budovy', 'Průkaz energetické náročnosti budovy',
+    'Zlevněno', 'Původní cena', 'ID zakázky', 'Převod do OV', 'Umístění objektu', 'Plocha podlahová',
+    'Rok kolaudace', 'Vybavení', 'Typ bytu', 'Poznámka k ceně', 'Lodžie', 'Garáž', 'Plyn', 'Výtah',
+    'Parkování', 'Bezbariérový', 'Plocha zahrady', 'Ukazatel energetické náročnosti budovy', 'Bazén',
+    'Terasa', 'Datum ukončení výstavby', 'Datum nastěhování', 'Cena', 'Výška stropu',
+    'Datum zahájení prodeje', 'Rok rekonstrukce', 'Náklady na bydlení', 'Půdní vestavba', 'Stav',
+    'Plocha zastavěná', 'Anuita', 'Datum prohlídky', 'Datum prohlídky do', 'Počet bytů',
+]
+
+class SchemaWarmupWriter:
+    """
+    Writes property details to a CSV file, taking its columns from the first properties written.
+
+    The first rows are buffered and every 'items' name found in them is added to the known
+    columns before the header is written. Later rows are written straight away; names outside
+    the discovered columns are ignored.
+
+    Args:
+        csv_file: The file object the CSV rows are written to.
+        fieldnames: The columns that are always written, in order.
+        warmup_rows: The number of rows buffered before the columns are fixed.
+    """
+
+    def __init__(self, csv_file, fieldnames, warmup_rows):
+        self._csv_file = csv_file
+        self._fieldnames = dict.fromkeys(fieldnames)  # Ordered set of the discovered columns
+        self._warmup_rows = warmup_rows
+        self._buffer = []
+        self._writer = None
+
+    def writerow(self, row):
+        """
+        Writes the details of one property, or buffers them while the columns are discovered.
+
+        Args:
+            row: A dictionary with the details of the property.
+        """
+        if self._writer is not None:
+            self._writer.writerow(row)
+            return
+
+        self._buffer.append(row)
+        self._fieldnames.update(dict.fromkeys(row))
+        if len(self._buffer) >= self._warmup_rows:
+            self.flush()
+
+    def flush(self):
+        """
+        Fixes the columns, then writes the header and the buffered rows if not done yet.
+        """
+        if self._writer is None:
+            self._writer = csv.DictWriter(self._csv_file, fieldnames=list(self._fieldnames), extrasaction='ignore')
+            self._writer.writeheader()
+            self._writer.writerows(self._buffer)
+            self._buffer = None
+
+def parse_detail(parser, detail_id, raw):
+    """
+    Extracts the property details from a raw detail JSON response.
+
+    The document is parsed with a reused simdjson parser and only the keys written to the
+    output are read from it. A parser can hold a single document at a time, so no simdjson
+    object may outlive this call; everything returned is converted to plain Python objects.
+
+    Args:
+        parser: A simdjson.Parser instance shared by all detail workers.
+        detail_id: The ID of the property, used for logging.
+        raw: The raw bytes of the detail JSON response.
+
+    Returns:
+        A dictionary with the details of the property.
+    """
+    json_info = parser.parse(raw)
+
+    # Look up each nested object once; '_embedded' and 'seller' may be missing or null
+    title = json_info.get('name') or {}
+    locality = json_info.get('locality') or {}
+    price_czk = json_info.get('price_czk') or {}
+    seller = (json_info.get('_embedded') or {}).get('seller') or {}
+
+    # Extract relevant property details from the JSON response
+    detail_data = {
+        'title': title.get('value', ''),
+        'description': json_info.get('meta_description', ''),
+        'address': locality.get('value', ''),
+        'price': price_czk.get('value_raw', ''),
+        'seller_name': seller.get('user_name', ''),
+        'seller_email': seller.get('email', ''),
+        'seller_id': seller.get('user_id', ''),
+        'code_number': '',
+        'seller_phone': '',
+    }
 
-async def fetch_detail(session, queue, all_details):
+    # Extract the phones list, with a default to an empty list if not found
+    phones_list = seller.get('phones') or []
+    # Check if the phones list is not empty and then extract the 'code'
+    if phones_list:
+        detail_data['code_number'] = phones_list[0].get('code', '')
+        detail_data['seller_phone'] = phones_list[0].get('number', '')
+    else:
+        logger.debug("No phone numbers found for property ID: %s", detail_id)
+
+    # Extract additional details from 'items' list in the JSON response
+    # Items are read straight from the parsed document; only nested values are materialized
+    dict_set = detail_data.__setitem__
+    for item in json_info.get('items') or []:
+        try:
+            name, value = _item_name_value(item)
+        except KeyError:
+            name, value = item.get('name'), item.get('value')
+        if isinstance(value, simdjson.Object):
+            value = value.as_dict()
+        elif isinstance(value, simdjson.Array):
+            value = value.as_list()
+        dict_set(name, value)
+
+    return detail_data
+
+def parse_detail_stream(detail_id, raw):
+    """
+    Extracts the property details from a raw detail JSON response by streaming its events.
+
+    Used instead of parse_detail when simdjson is not installed. Only the events of the fields
+    written to the output are acted on; nested item values are the only objects that get built.
+
+    Args:
+        detail_id: The ID of the property, used for logging.
+        raw: The raw bytes of the detail JSON response.
+
+    Returns:
+        A dictionary with the details of the property.
+    """
+    detail_data = dict.fromkeys([*_STREAM_FIELDS.values(), *_STREAM_PHONE_FIELDS.values()], '')
+    phones_seen = 0
+    item_name = item_value = None
+    builder = None  # Collects the events of a nested item value while it is being read
+
+    for prefix, event, value in ijson.parse(raw, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == 'items.item.value' and event in ('end_map', 'end_array'):
+                item_value = builder.value
+                builder = None
+        elif prefix == 'items.item.value':
+            if event in ('start_map', 'start_array'):
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+            else:
+                item_value = value
+        elif prefix == 'items.item.name':
+            item_name = value
+        elif prefix == 'items.item':
+            # Keys of an item may come in any order, so store it once the whole item is read
+            if event == 'start_map':
+                item_name = item_value = None
+            elif event == 'end_map':
+                detail_data[item_name] = item_value
+        elif prefix in _STREAM_FIELDS:
+            detail_data[_STREAM_FIELDS[prefix]] = value
+        elif prefix in _STREAM_PHONE_FIELDS:
+            # Only the first phone number of the seller is kept
+            if not phones_seen:
+                detail_data[_STREAM_PHONE_FIELDS[prefix]] = value
+        elif prefix == '_embedded.seller.phones.item' and event == 'end_map':
+            phones_seen += 1
+
+    if not phones_seen:
+        logger.debug("No phone numbers found for property ID: %s", detail_id)
+
+    return detail_data
+
+async def fetch_detail(client, parser, queue, writer):
     """
     Fetches details for a specific property identified by its ID from the Sreality website.
 
+    The task keeps taking property IDs from the queue until it is cancelled.
+
     Args:
-        session: An aiohttp client session object used for making HTTP requests.
+        client: An httpx async client used for making HTTP requests.
+        parser: A simdjson.Parser instance reused for parsing the detail responses, or None to
+            stream them with ijson.
         queue: An asyncio queue used to manage the retrieval of property IDs.
-        all_details: A list to store the details of all scraped properties.
+        writer: A SchemaWarmupWriter the details of each scraped property are written to.
     """
     while True:
         detail_id = await queue.get()
-        if detail_id is None:  # Sentinel value to indicate completion
-            break
-        
-        logging.info(f"Fetching details for property ID: {detail_id}")
-        
-        detail_url = f'https://www.sreality.cz/api/cs/v2/estates/{detail_id}'
+
+        logger.info("Fetching details for property ID: %s", detail_id)
+
+        detail_url = f'{_DETAIL_URL}{detail_id}'
         try:
-            async with session.get(detail_url) as response:
-                if response.status == 200:
-                    json_info = await response.json()
-                    
-                    # Extract relevant property details from the JSON response
-                    detail_data = {
-                        'title': json_info.get('name', {}).get('value', ''),
-                        'description': json_info.get('meta_description', ''),
-                        'address': json_info.get('locality', {}).get('value', ''),
-                        'price': json_info.get('price_czk', {}).get('value_raw', ''),
-                        'seller_name': json_info.get('_embedded').get('seller', {}).get('user_name', ''),
-                        'seller_email': json_info.get('_embedded').get('seller', {}).get('email', ''),
-                        'seller_id': json_info.get('_embedded').get('seller', {}).get('user_id', ''),
-                        'code_number': '',
-                        'seller_phone': '',
-                    }
-                    
-                    # Extract the phones list, with a default to an empty list if not found
-                    phones_list = json_info.get('_embedded', {}).get('seller', {}).get('phones', [])
-                    # Check if the phones list is not empty and then extract the 'code'
-                    if phones_list:
-                        detail_data['code_number'] = phones_list[0].get('code', '')
-                        detail_data['seller_phone'] = phones_list[0].get('number', '')
-                    else:
-                        logging.debug(f"No phone numbers found for property ID: {detail_id}")
-                        detail_data['code_number'] = ''
-                        detail_data['seller_phone'] = ''
-
-                     # Extract additional details from 'items' list in the JSON response
-                    for item in json_info['items']:
-                        name = item.get('name')
-                        value = item.get('value')
-                        detail_data = {**detail_data, **{name: value}}
-                        # detail_data[name] = value
-                    
-                    all_details.append(detail_data)
-                    logging.info(f'Successfully fetched detail {detail_id}')
+            response = await client.get(detail_url)
+            if response.status_code == 200:
+                if parser is not None:
+                    detail_data = parse_detail(parser, detail_id, response.content)
                 else:
-                    logging.error(f"Error fetching detail {detail_id}: {response.status}")
-        except aiohttp.ClientError as e:
-            logging.exception(f"Client error fetching detail {detail_id}: {e}")
+                    detail_data = parse_detail_stream(detail_id, response.content)
+
+                # The row is written without awaiting, so workers never interleave within the file
+                writer.writerow(detail_data)
+                logger.info('Successfully fetched detail %s', detail_id)
+            else:
+                logger.error("Error fetching detail %s: %s", detail_id, response.status_code)
+        except httpx.HTTPError as e:
+            logger.exception("Client error fetching detail %s: %s", detail_id, e)
+        except Exception as e:
+            # A malformed response must not stop the worker, whichever parser rejects it
+            logger.exception("Error processing detail %s: %s", detail_id, e)
         finally:
             queue.task_done()
 
-async def fetch_page(session, page_number, queue):
+async def fetch_page(client, page_number, queue):
     """
     Fetches a specific page from the Sreality search results and extracts property IDs for details retrieval.
 
     Args:
-        session: An aiohttp client session object used for making HTTP requests.
+        client: An httpx async client used for making HTTP requests.
         page_number: The page number to fetch from the search results.
         queue: An asyncio queue used to store property IDs for detail retrieval.
 
     Returns:
         True if property IDs were found on the fetched page, False otherwise.
     """
-    headers = {
-        'accept': 'application/json, text/plain, */*',
-        'accept-language': 'sk-SK,sk;q=0.9,cs;q=0.8,en-US;q=0.7,en;q=0.6',
-        'referer': 'https://www.sreality.cz/hledani/prodej/byty?no_shares=1&bez-aukce=1',
-        'sec-ch-ua': '"Google"',
-        'sec-ch-ua-mobile': '?0',
-        'sec-ch-ua-platform': '"Windows"',
-        'sec-fetch-dest': 'empty',
-        'sec-fetch-mode': 'cors',
-        'sec-fetch-site': 'same-origin',
-        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36',
-    }
-    page_url = f'https://www.sreality.cz/api/cs/v2/estates?category_main_cb=1&category_type_cb=1&no_shares=1&bez-aukce=1&page={page_number}'
+    page_url = f'{_PAGE_URL}{page_number}'
     try:
-        async with session.get(page_url, headers=headers) as response:
-            if response.status == 200:
-                json_data = await response.json()
-                start_point = json_data['_embedded']['estates']
-                if start_point:
-                    for estate in start_point:
-                        detail_id = estate.get('hash_id', '')
-                        if detail_id:
-                            await queue.put(detail_id)
-                    logging.info(f'Successfully fetched page {page_number}')
-                    return True
-                else:
-                    logging.warning(f'No estates found on page {page_number}')
-                    return False
+        response = await client.get(page_url)
+        if response.status_code == 200:
+            # The IDs are the only field needed, so they are matched in the raw body without parsing it
+            detail_ids = list(dict.fromkeys(int(match) for match in _HASH_ID_RE.findall(response.content)))
+            if not detail_ids:
+                # Parse the page only to confirm it is empty rather than in an unexpected format
+                estates = orjson.loads(response.content)['_embedded']['estates']
+                detail_ids = [estate['hash_id'] for estate in estates if estate.get('hash_id')]
+            if detail_ids:
+                # Only wait for the queue when it is full, instead of once per property
+                for detail_id in detail_ids:
+                    try:
+                        queue.put_nowait(detail_id)
+                    except asyncio.QueueFull:
+                        await queue.put(detail_id)
+                logger.info('Successfully fetched page %s', page_number)
+                return True
             else:
-                logging.error(f"Error fetching page {page_number}: {response.status}")
+                logger.warning('No estates found on page %s', page_number)
                 return False
-    except aiohttp.ClientError as e:
-        logging.exception(f"Client error fetching page {page_number}: {e}")
+        else:
+            logger.error("Error fetching page %s: %s", page_number, response.status_code)
+            return False
+    except httpx.HTTPError as e:
+        logger.exception("Client error fetching page %s: %s", page_number, e)
+        return False
+    except (ValueError, KeyError, TypeError) as e:
+        logger.exception("Error parsing page %s: %s", page_number, e)
         return False
 
 async def main():
     """
     The main function that orchestrates the scraping process.
 
-    This function starts an aiohttp client session, creates a queue for managing property IDs,
-    and a list to store scraped property details. It then iterates through web pages,
-    extracting property IDs and fetching details for each property concurrently.
-    Finally, it converts the scraped data into a Pandas DataFrame.
+    This function starts an HTTP/2 httpx client, creates a queue for managing property IDs,
+    and opens the output CSV file. It then fetches web pages in concurrent batches, extracting
+    property IDs and fetching details for each property concurrently. Once the first properties
+    have fixed the CSV columns, each property is written as soon as its details are fetched.
     """
-    async with aiohttp.ClientSession() as session:
-        queue = asyncio.Queue()
-        all_details = []
-        page_number = 800  # Start from page 1
-        detail_tasks = []
+    # HTTP/2 multiplexes the concurrent requests over a few long-lived connections to the API
+    limits = httpx.Limits(max_connections=10, max_keepalive_connections=10, keepalive_expiry=60)
+    async with httpx.AsyncClient(http2=True, limits=limits, headers=_PAGE_HEADERS, timeout=30) as client:
+        with open(OUTPUT_CSV, 'w', newline='', encoding='utf-8-sig') as csv_file:
+            writer = SchemaWarmupWriter(csv_file, CSV_FIELDNAMES, SCHEMA_WARMUP)
+            parser = simdjson.Parser() if simdjson is not None else None
+            # A bounded queue makes page fetching wait while the detail tasks catch up
+            queue = asyncio.Queue(maxsize=200)
+            page_number = 800  # Start from page 1
         
-        start_time = time.time()
-        # Continue looping as long as 'proced' is True
-        logging.info(f"Scraping process started at {time.strftime('%Y-%m-%d %H:%M:%S')}")
+            start_time = time.time()
+            logger.info("Scraping process started at %s", time.strftime('%Y-%m-%d %H:%M:%S'))
+
+            # Start the detail tasks so they consume property IDs while further pages are fetched
+            detail_tasks = [
+                asyncio.create_task(fetch_detail(client, parser, queue, writer))
+                for _ in range(DETAIL_TASKS)
+            ]
         
-        while True:
-            logging.info(f'Currently scraping page: {page_number}')
-            page_fetched = await fetch_page(session, page_number, queue)
-            if not page_fetched:
-                logging.warning(f"No details found on page {page_number}, skipping.")
-                break
-
-            # Start detail tasks if they haven't been started yet
-            if not detail_tasks:
-                for _ in range(50):  # Adjust the number of concurrent tasks as needed
-                    task = asyncio.create_task(fetch_detail(session, queue, all_details))
-                    detail_tasks.append(task)
-
-            page_number += 1
-            
-        # Signal the detail tasks to exit
-        for _ in detail_tasks:
-            await queue.put(None)
-
-        # Wait for all detail tasks to complete
-        await asyncio.gather(*detail_tasks)
-
-        # Convert all_details to a DataFrame and print it (optional)
-        try:
-            df = pd.DataFrame(all_details)
-            # df.to_csv('scrape sreality/sreality_output_data.csv', index=False, encoding='utf-8-sig')
-            logging.info(f"Successfully created DataFrame with scraped data.")
-            print(df)
-        except Exception as e:
-            logging.error(f"Error creating DataFrame: {e}")
+            try:
+                # Fetch pages in batches and stop at the first batch that contains an empty page
+                while True:
+                    logger.info('Currently scraping pages: %s-%s', page_number, page_number + PAGE_PREFETCH - 1)
+                    pages_fetched = await asyncio.gather(
+                        *(fetch_page(client, page_number + i, queue) for i in range(PAGE_PREFETCH))
+                    )
+                    if not all(pages_fetched):
+                        last_page = page_number + pages_fetched.index(False)
+                        logger.warning("No details found on page %s, stopping.", last_page)
+                        break
+
+                    page_number += PAGE_PREFETCH
+
+                # Wait until every queued property has been processed
+                await queue.join()
+            finally:
+                # Stop the detail tasks, also when the scrape fails or is interrupted, so none of
+                # them keeps using the client or the CSV file once they are closed
+                for task in detail_tasks:
+                    task.cancel()
+                results = await asyncio.gather(*detail_tasks, return_exceptions=True)
+                for result in results:
+                    if isinstance(result, BaseException) and not isinstance(result, asyncio.CancelledError):
+                        logger.error("Detail task failed: %r", result)
+
+                # Write out the buffered properties even if fewer than SCHEMA_WARMUP were scraped
+                writer.flush()
+
+            logger.info("Successfully wrote scraped data to %s", OUTPUT_CSV)
 
-        # Get the current time after the completion of the operation
-        end_time = time.time()
+            # Get the current time after the completion of the operation
+            end_time = time.time()
 
-        # Log information about the duration of the operation
-        logging.info(f"This operation took: {end_time - start_time} seconds")
+            # Log information about the duration of the operation
+            logger.info("This operation took: %s seconds", end_time - start_time)
 
-        # Calculate the total duration of the operation in seconds
-        duration_seconds = end_time - start_time
+            # Calculate the total duration of the operation in seconds
+            duration_seconds = end_time - start_time
 
-        # Convert the total duration to minutes and seconds
-        minutes, seconds = divmod(duration_seconds, 60)
-        duration_in_minutes = int(minutes)  # Total number of minutes
-        duration_in_seconds = int(seconds)  # Total number of seconds
+            # Convert the total duration to minutes and seconds
+            minutes, seconds = divmod(duration_seconds, 60)
+            duration_in_minutes = int(minutes)  # Total number of minutes
+            duration_in_seconds = int(seconds)  # Total number of seconds
 
-        # Log information about the duration of the operation in minutes and seconds
-        logging.info(f"This operation took: {duration_in_minutes} minutes {duration_in_seconds} seconds")
+            # Log information about the duration of the operation in minutes and seconds
+            logger.info("This operation took: %s minutes %s seconds", duration_in_minutes, duration_in_seconds)
 
-# Run the main function
+# Run the main function, on the uvloop event loop when it is installed
 if __name__ == '__main__':
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())